@@ -1,7 +1,29 @@
+import functools
 import pkgutil
 import yaml
 
 from munch import Munch
 
-m2m_urls = pkgutil.get_data(__name__, 'm2m_urls.yml')
-M2M_URLS = Munch.fromDict(yaml.safe_load(m2m_urls))
+# use the libyaml based loader, if available, as it is considerably faster than the pure python version
+try:
+    from yaml import CSafeLoader as SafeLoader
+except ImportError:
+    from yaml import SafeLoader
+
+
+@functools.lru_cache(maxsize=1)
+def load_m2m_urls():
+    """
+    Load and parse the m2m_urls.yml file used to construct the M2M requests. The file is large, so it is only parsed
+    the first time the M2M_URLS dictionary is needed, rather than every time the package is imported.
+
+    :return: M2M_URLS dictionary
+    """
+    m2m_urls = pkgutil.get_data(__name__, 'm2m_urls.yml')
+    return Munch.fromDict(yaml.load(m2m_urls, Loader=SafeLoader))
+
+
+def __getattr__(name):
+    if name == 'M2M_URLS':
+        return load_m2m_urls()
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
@@ -6,31 +6,42 @@
     M2M interface
 """
 import argparse
-import collections
+import functools
+import inspect
 import netrc
 import numpy as np
 import os
 import re
 import requests
+import sqlite3
 import sys
+import tempfile
+import threading
 import time
 import warnings
 import xarray as xr
 import datetime
 import pandas as pd
 
-from bs4 import BeautifulSoup
+from collections import Counter
+from collections.abc import Mapping, MutableMapping
+from concurrent.futures import ThreadPoolExecutor
+from lxml import html
 from tqdm import tqdm
 
 from requests.adapters import HTTPAdapter
+from requests.auth import HTTPBasicAuth
+from requests_cache import CachedSession, DO_NOT_CACHE
 from urllib3.util import Retry
 
-# setup constants used to access the data from the different M2M interfaces
-SESSION = requests.Session()
-retry = Retry(connect=5, backoff_factor=0.5)
-adapter = HTTPAdapter(max_retries=retry)
-SESSION.mount('https://', adapter)
+# use orjson, if available, to decode the JSON responses from OOINet as it is considerably faster than the standard
+# library version
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
 
+# setup constants used to access the data from the different M2M interfaces
 BASE_URL = 'https://ooinet.oceanobservatories.org/api/m2m/'  # base M2M URL
 ANNO_URL = '12580/anno/'                                     # Annotation Information
 ASSET_URL = '12587/asset/'                                   # Asset and Calibration Information
@@ -57,9 +68,23 @@ CONFIG = {
         'raw_base': os.path.abspath(os.path.join(home, 'ooidata/raw')),
         'json_base': os.path.abspath(os.path.join(home, 'ooidata/json')),
         'm2m_base': os.path.abspath(os.path.join(home, 'ooidata/m2m'))
-    }
+    },
+    'cache_dir': os.path.abspath(os.path.join(home, 'ooidata/cache')),
+    'cache_size': 0     # maximum size, in bytes, of the local cache of THREDDS data files (0 disables the cache)
 }
 
+# the shared session with the access credentials is created on first use (see get_session), so importing this module
+# does not touch the file system. The reference metadata (sensor inventory, deployments, vocabulary, streams and
+# parameters) rarely changes, so those responses are cached on disk between runs. Data requests (anything with a query
+# string against the sensor inventory), the sensor metadata (the begin and end times of the available data change
+# daily for telemetered and streamed data) and everything else are never cached.
+META_EXPIRE = 86400 * 7         # cache the reference metadata for a week
+DEPLOY_EXPIRE = 86400           # deployments are added and closed out more often, so only cache those for a day
+DEFAULT_TIMEOUT = (5, 60)       # (connect, read) timeouts in seconds for the M2M API and THREDDS catalog requests
+DOWNLOAD_TIMEOUT = (5, 300)     # longer read timeout for downloading the data files
+SESSION_LOCK = threading.Lock()
+session = None
+
 # Default NetCDF encodings for CF compliance
 ENCODINGS = {
     'time': {'_FillValue': None},
@@ -68,6 +93,27 @@ ENCODINGS = {
     'z': {'_FillValue': None}
 }
 
+# regex patterns used to identify the THREDDS catalog files and the QC variables in the downloaded data sets
+CATALOG_RE = re.compile(r'catalog\.html\?dataset=')
+QC_RE = re.compile(r'^(?P<base>.+)_qc_(?P<kind>.+)$')
+QARTOD_EXECUTED_RE = re.compile(r'^.+_qartod_executed$')
+QARTOD_RESULTS_RE = re.compile(r'^.+_qartod_results$')
+
+# coordinate variables added to the data sets, these do not get a coordinates attribute
+COORD_VARS = ['time', 'lat', 'lon', 'z', 'station']
+
+# variables in the downloaded NetCDF files that are never used, and so are dropped before the data is loaded
+DROP_VARS = ['id', 'provenance', 'driver_timestamp', 'ingestion_timestamp', 'port_timestamp', 'preferred_timestamp']
+
+# limit the number of files concurrently downloaded from the OOI THREDDS server
+MAX_WORKERS = 8
+THREDDS_LIMIT = threading.Semaphore(MAX_WORKERS)
+
+# track the cached THREDDS data files in use by this process, so they are not removed from the cache while needed
+CACHE_LOCK = threading.Lock()
+CACHE_IN_USE = Counter()
+PART_EXPIRE = 86400     # partial downloads older than a day were orphaned by a killed process, and can be removed
+
 
 class Error(Exception):
     """Base class for exceptions in this module."""
@@ -85,6 +131,151 @@ class InputError(Error):
         self.message = message
 
 
+class RequestFailed(Error):
+    """Raised internally when a memoized request fails, so the failure is not cached."""
+    pass
+
+
+class OOINetAuth(HTTPBasicAuth):
+    """Basic authentication with the OOINet API user name and token, sent only with requests to the M2M API."""
+
+    def __call__(self, r):
+        if r.url.startswith(BASE_URL):
+            return super().__call__(r)
+        return r
+
+
+def memoize(func):
+    """
+    Memoize the results of a metadata lookup in memory. Only successful
+    results are kept; a lookup that returns None (a failed request) is tried
+    again the next time it is called. The cached results are shared by all
+    callers, so they must not be modified.
+
+    :param func: lookup function to memoize
+    :return: memoized version of the function
+    """
+    signature = inspect.signature(func)
+
+    @functools.lru_cache(maxsize=4096)
+    def cached(*args):
+        result = func(*args)
+        if result is None:
+            raise RequestFailed('Request failed, not caching the result')
+        return result
+
+    @functools.wraps(func)
+    def wrapper(*args, **kwargs):
+        # bind the arguments to the function's parameters, so positional and keyword calls share a cache entry
+        bound = signature.bind(*args, **kwargs)
+        bound.apply_defaults()
+        try:
+            return cached(*bound.args)
+        except RequestFailed:
+            return None
+
+    wrapper.cache_clear = cached.cache_clear
+    return wrapper
+
+
+def create_session():
+    """
+    Creates a session with the access credentials, so the connections to
+    OOINet are pooled and reused (keep-alive) across requests rather than
+    re-negotiated for every call. The session caches the reference metadata
+    on disk, falling back to an uncached session if the cache directory
+    cannot be created or written to.
+
+    :return: requests session object
+    """
+    try:
+        os.makedirs(CONFIG['cache_dir'], exist_ok=True)
+        s = CachedSession(
+            cache_name=os.path.join(CONFIG['cache_dir'], 'ooi_meta'),
+            backend='sqlite',
+            expire_after=DO_NOT_CACHE,
+            allowable_methods=('GET', 'HEAD'),
+            urls_expire_after={
+                BASE_URL + SENSOR_URL + '*[?]*': DO_NOT_CACHE,
+                BASE_URL + SENSOR_URL + '*/metadata': DO_NOT_CACHE,
+                BASE_URL + SENSOR_URL: META_EXPIRE,
+                BASE_URL + DEPLOY_URL: DEPLOY_EXPIRE,
+                BASE_URL + VOCAB_URL: META_EXPIRE,
+                BASE_URL + STREAM_URL: META_EXPIRE,
+                BASE_URL + PARAMETER_URL: META_EXPIRE
+            }
+        )
+    except (OSError, sqlite3.Error) as e:
+        warnings.warn('Unable to create the metadata cache in {}, continuing without it: {}'.format(
+            CONFIG['cache_dir'], e))
+        s = requests.Session()
+
+    s.auth = OOINetAuth(AUTH[0], AUTH[2])  # the THREDDS server does not need (or get) the credentials
+    s.headers.update({'Accept': 'application/json'})
+    retry = Retry(total=5, backoff_factor=0.5, status_forcelist=(500, 502, 503, 504), raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=4, pool_maxsize=16, max_retries=retry)
+    s.mount('https://', adapter)
+    s.mount('http://', adapter)
+    return s
+
+
+def get_session():
+    """
+    Returns the shared session, creating it on first use.
+
+    :return: requests session object
+    """
+    global session
+    with SESSION_LOCK:
+        if session is None:
+            session = create_session()
+    return session
+
+
+def __getattr__(name):
+    # keep SESSION available as a module attribute for existing scripts, without creating it at import
+    if name == 'SESSION':
+        return get_session()
+    raise AttributeError('module {!r} has no attribute {!r}'.format(__name__, name))
+
+
+def close_session():
+    """
+    Closes the shared session, releasing any pooled connections. The session
+    will re-open connections as needed if it is used again.
+
+    :return: None
+    """
+    if session is not None:
+        session.close()
+
+
+def clear_cache():
+    """
+    Clears the on-disk cache of OOINet metadata responses, and the in-memory
+    cache of the metadata lookups, forcing the next request for any of that
+    information to go back to the server.
+
+    :return: None
+    """
+    s = get_session()
+    if isinstance(s, CachedSession):
+        s.cache.clear()
+    for lookup in (list_methods, list_streams, get_parameter_information, get_stream_information, get_vocabulary):
+        lookup.cache_clear()
+
+
+def parse_json(r):
+    """
+    Decode the JSON content of a response from OOINet, working directly from
+    the raw bytes of the response.
+
+    :param r: response object returned by the session
+    :return: decoded JSON object
+    """
+    return json_loads(r.content)
+
+
 # Sensor Information
 def list_sites():
     """
@@ -93,9 +284,9 @@ def list_sites():
 
     :return: list of all available sites in the system
     """
-    r = SESSION.get(BASE_URL + SENSOR_URL, auth=(AUTH[0], AUTH[2]))
+    r = get_session().get(BASE_URL + SENSOR_URL, timeout=DEFAULT_TIMEOUT)
     if r.status_code == requests.codes.ok:
-        return r.json()
+        return parse_json(r)
     else:
         return None
 
@@ -107,9 +298,9 @@ def list_nodes(site):
     :param site: Site name to query
     :return: List of the the available nodes for this site
     """
-    r = SESSION.get(BASE_URL + DEPLOY_URL + site, auth=(AUTH[0], AUTH[2]))
+    r = get_session().get(BASE_URL + DEPLOY_URL + site, timeout=DEFAULT_TIMEOUT)
     if r.status_code == requests.codes.ok:
-        return r.json()
+        return parse_json(r)
     else:
         return None
 
@@ -122,33 +313,37 @@ def list_sensors(site, node):
     :param node: Node name to query
     :return: list of the the available sensors for this site and node
     """
-    r = SESSION.get(BASE_URL + DEPLOY_URL + site + '/' + node, auth=(AUTH[0], AUTH[2]))
+    r = get_session().get(BASE_URL + DEPLOY_URL + site + '/' + node, timeout=DEFAULT_TIMEOUT)
     if r.status_code == requests.codes.ok:
-        return r.json()
+        return parse_json(r)
     else:
         return None
 
 
+@memoize
 def list_methods(site, node, sensor):
     """
     Based on the site, node and sensor name, list the data delivery methods that are available.
+    The result is cached and shared with other callers, so make a copy before modifying it.
 
     :param site: Site name to query
     :param node: Node name to query
     :param sensor: Sensor name to query
     :return: list of the data delivery methods associated with this site, node and sensor
     """
-    r = SESSION.get(BASE_URL + SENSOR_URL + site + '/' +
-                    node + '/' + sensor, auth=(AUTH[0], AUTH[2]))
+    r = get_session().get(BASE_URL + SENSOR_URL + site + '/' +
+                          node + '/' + sensor, timeout=DEFAULT_TIMEOUT)
     if r.status_code == requests.codes.ok:
-        return r.json()
+        return parse_json(r)
     else:
         return None
 
 
+@memoize
 def list_streams(site, node, sensor, method):
     """
     Based on the site, node and sensor name and the data delivery method, list the data streams that are available.
+    The result is cached and shared with other callers, so make a copy before modifying it.
 
     :param site: Site name to query
     :param node: Node name to query
@@ -157,10 +352,10 @@ def list_streams(site, node, sensor, method):
     :return: list of the data streams associated with this site, node, sensor and data delivery method
     """
     # Determine the streams associated with the delivery method available for this sensor
-    r = SESSION.get(BASE_URL + SENSOR_URL + site + '/' + node + '/' +
-                    sensor + '/' + method, auth=(AUTH[0], AUTH[2]))
+    r = get_session().get(BASE_URL + SENSOR_URL + site + '/' + node + '/' +
+                          sensor + '/' + method, timeout=DEFAULT_TIMEOUT)
     if r.status_code == requests.codes.ok:
-        return r.json()
+        return parse_json(r)
     else:
         return None
 
@@ -175,39 +370,84 @@ def list_metadata(site, node, sensor):
     :param sensor: Sensor name to query
     :return: dictionary with the parameters and available time ranges available for the sensor
     """
-    r = SESSION.get(BASE_URL + SENSOR_URL + site + '/' + node + '/' +
-                    sensor + '/metadata', auth=(AUTH[0], AUTH[2]))
+    r = get_session().get(BASE_URL + SENSOR_URL + site + '/' + node + '/' +
+                          sensor + '/metadata', timeout=DEFAULT_TIMEOUT)
     if r.status_code == requests.codes.ok:
-        return r.json()
+        return parse_json(r)
     else:
         return None
 
 
+def crawl_site(site, node_filter=None, sensor_filter=None, method_filter=None, max_workers=MAX_WORKERS):
+    """
+    Based on the site name, walk the sensor inventory to list the nodes, sensors, data delivery methods and data
+    streams that are available. The requests at each level of the inventory are made concurrently, so crawling a
+    full site takes a handful of round trips to OOINet rather than one per node, sensor and method. Optional filters
+    limit the crawl to the parts of the inventory of interest, avoiding requests for anything that will be discarded.
+
+    :param site: Site name to query
+    :param node_filter: Function called with a node name, returns True if the node should be included (Optional,
+        default includes all nodes)
+    :param sensor_filter: Function called with a sensor name, returns True if the sensor should be included
+        (Optional, default includes all sensors)
+    :param method_filter: Function called with a data delivery method, returns True if the streams for that method
+        should be listed. Methods that are filtered out are still included, but with an empty list of streams
+        (Optional, default lists the streams for all methods)
+    :param max_workers: Maximum number of concurrent requests to make
+    :return: nested dictionary of the nodes, sensors and data delivery methods, with the list of data streams
+        associated with each method
+    """
+    node_filter = node_filter or (lambda node: True)
+    sensor_filter = sensor_filter or (lambda sensor: True)
+    method_filter = method_filter or (lambda method: True)
+
+    inventory = {node: {} for node in list_nodes(site) or [] if node_filter(node)}
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        keys = list(inventory)
+        for node, sensors in zip(keys, executor.map(lambda k: list_sensors(site, k), keys)):
+            inventory[node] = {sensor: {} for sensor in sensors or [] if sensor_filter(sensor)}
+
+        keys = [(node, sensor) for node in inventory for sensor in inventory[node]]
+        for (node, sensor), methods in zip(keys, executor.map(lambda k: list_methods(site, *k), keys)):
+            inventory[node][sensor] = {method: [] for method in methods or []}
+
+        keys = [(node, sensor, method) for node in inventory for sensor in inventory[node]
+                for method in inventory[node][sensor] if method_filter(method)]
+        for (node, sensor, method), streams in zip(keys, executor.map(lambda k: list_streams(site, *k), keys)):
+            inventory[node][sensor][method] = streams or []
+
+    return inventory
+
+
 # Preload Information
+@memoize
 def get_parameter_information(parameter_id):
     """
     Use the Parameter ID# to retrieve information about the parameter: units, sources, data product ID, comments,etc.
+    The result is cached and shared with other callers, so make a copy before modifying it.
 
     :param parameter_id: Parameter ID# of interest
     :return: json object with information on the parameter of interest
     """
-    r = SESSION.get(BASE_URL + PARAMETER_URL + parameter_id, auth=(AUTH[0], AUTH[2]))
+    r = get_session().get(BASE_URL + PARAMETER_URL + parameter_id, timeout=DEFAULT_TIMEOUT)
     if r.status_code == requests.codes.ok:
-        return r.json()
+        return parse_json(r)
     else:
         return None
 
 
+@memoize
 def get_stream_information(stream):
     """
     Use the stream name to retrieve information about the stream contents: parameters, units, sources, etc.
+    The result is cached and shared with other callers, so make a copy before modifying it.
 
     :param stream: Stream name of interest
     :return: json object with information on the contents of the stream
     """
-    r = SESSION.get(BASE_URL + STREAM_URL + stream, auth=(AUTH[0], AUTH[2]))
+    r = get_session().get(BASE_URL + STREAM_URL + stream, timeout=DEFAULT_TIMEOUT)
     if r.status_code == requests.codes.ok:
-        return r.json()
+        return parse_json(r)
     else:
         return None
 
@@ -221,9 +461,9 @@ def get_asset_by_uid(uid):
     :param uid: unique asset identifier (UID), e.g. CGINS-DOSTAD-00134
     :return: asset information for the identified UID
     """
-    r = SESSION.get(BASE_URL + ASSET_URL + '?uid=' + uid, auth=(AUTH[0], AUTH[2]))
+    r = get_session().get(BASE_URL + ASSET_URL + '?uid=' + uid, timeout=DEFAULT_TIMEOUT)
     if r.status_code == requests.codes.ok:
-        return r.json()
+        return parse_json(r)
     else:
         return None
 
@@ -236,9 +476,9 @@ def get_asset_by_asset_id(asset_id):
     :param asset_id: OOI asset identifier (assetId), e.g. 1352
     :return: asset information for the identified assetId
     """
-    r = SESSION.get(BASE_URL + ASSET_URL + '/' + str(asset_id), auth=(AUTH[0], AUTH[2]))
+    r = get_session().get(BASE_URL + ASSET_URL + '/' + str(asset_id), timeout=DEFAULT_TIMEOUT)
     if r.status_code == requests.codes.ok:
-        return r.json()
+        return parse_json(r)
     else:
         return None
 
@@ -253,10 +493,10 @@ def list_deployments(site, node, sensor):
     :param sensor: Sensor name to query
     :return: list of the deployments of this site, node and sensor combination
     """
-    r = SESSION.get(BASE_URL + DEPLOY_URL + site + '/' +
-                    node + '/' + sensor, auth=(AUTH[0], AUTH[2]))
+    r = get_session().get(BASE_URL + DEPLOY_URL + site + '/' +
+                          node + '/' + sensor, timeout=DEFAULT_TIMEOUT)
     if r.status_code == requests.codes.ok:
-        return r.json()
+        return parse_json(r)
     else:
         return None
 
@@ -273,10 +513,10 @@ def get_sensor_information(site, node, sensor, deploy):
     :param deploy: Deployment number
     :return: json object with the site-node-sensor-deployment specific sensor metadata
     """
-    r = SESSION.get(BASE_URL + DEPLOY_URL + site + '/' + node + '/' + sensor + '/' + str(deploy),
-                    auth=(AUTH[0], AUTH[2]))
+    r = get_session().get(BASE_URL + DEPLOY_URL + site + '/' + node + '/' + sensor + '/' + str(deploy),
+                          timeout=DEFAULT_TIMEOUT)
     if r.status_code == requests.codes.ok:
-        return r.json()
+        return parse_json(r)
     else:
         return None
 
@@ -288,10 +528,10 @@ def get_sensor_history(uid):
     :param uid: unique asset identifier (UID)
     :return: json object with the asset and calibration information
     """
-    r = SESSION.get(BASE_URL + ASSET_URL + '/deployments/' +
-                    uid + '?editphase=ALL', auth=(AUTH[0], AUTH[2]))
+    r = get_session().get(BASE_URL + ASSET_URL + '/deployments/' +
+                          uid + '?editphase=ALL', timeout=DEFAULT_TIMEOUT)
     if r.status_code == requests.codes.ok:
-        return r.json()
+        return parse_json(r)
     else:
         return None
 
@@ -337,9 +577,9 @@ def get_calibrations_by_uid(uid):
     :param uid: unique asset identifier (UID), e.g. CGINS-DOSTAD-00134
     :return: calibration information for the identified UID
     """
-    r = SESSION.get(BASE_URL + ASSET_URL + '/cal?uid=' + uid, auth=(AUTH[0], AUTH[2]))
+    r = get_session().get(BASE_URL + ASSET_URL + '/cal?uid=' + uid, timeout=DEFAULT_TIMEOUT)
     if r.status_code == requests.codes.ok:
-        return r.json()
+        return parse_json(r)
     else:
         return None
 
@@ -352,9 +592,9 @@ def get_calibrations_by_asset_id(asset_id):
     :param asset_id: OOI asset identifier (assetId), e.g. 1352
     :return: calibration information for the identified assetId
     """
-    r = SESSION.get(BASE_URL + ASSET_URL + '/cal?assetid=' + str(asset_id), auth=(AUTH[0], AUTH[2]))
+    r = get_session().get(BASE_URL + ASSET_URL + '/cal?assetid=' + str(asset_id), timeout=DEFAULT_TIMEOUT)
     if r.status_code == requests.codes.ok:
-        return r.json()
+        return parse_json(r)
     else:
         return None
 
@@ -377,17 +617,17 @@ def get_calibrations_by_refdes(site, node, sensor, start=None, stop=None):
         reference designator
     """
     if start and stop:
-        r = SESSION.get(BASE_URL + ASSET_URL + '/cal?refdes=' + site + '-' + node + '-' + sensor + '&beginDT=' +
-                        start + '&endDT=' + stop, auth=(AUTH[0], AUTH[2]))
+        r = get_session().get(BASE_URL + ASSET_URL + '/cal?refdes=' + site + '-' + node + '-' + sensor + '&beginDT=' +
+                              start + '&endDT=' + stop, timeout=DEFAULT_TIMEOUT)
     elif not start and not stop:
-        r = SESSION.get(BASE_URL + ASSET_URL + '/cal?refdes=' + site + '-' + node + '-' + sensor,
-                        auth=(AUTH[0], AUTH[2]))
+        r = get_session().get(BASE_URL + ASSET_URL + '/cal?refdes=' + site + '-' + node + '-' + sensor,
+                              timeout=DEFAULT_TIMEOUT)
     else:
         raise InputError(
             'You must specify both start and stop time, or leave both of those fields empty.')
 
     if r.status_code == requests.codes.ok:
-        return r.json()
+        return parse_json(r)
     else:
         return None
 
@@ -405,10 +645,10 @@ def get_annotations(site, node, sensor):
     :param sensor: Sensor name to query
     :return:
     """
-    r = SESSION.get(BASE_URL + ANNO_URL + 'find?beginDT=0&refdes=' + site + '-'
-                    + node + '-' + sensor, auth=(AUTH[0], AUTH[2]))
+    r = get_session().get(BASE_URL + ANNO_URL + 'find?beginDT=0&refdes=' + site + '-'
+                          + node + '-' + sensor, timeout=DEFAULT_TIMEOUT)
     if r.status_code == requests.codes.ok:
-        return r.json()
+        return parse_json(r)
     else:
         return None
 
@@ -544,19 +784,21 @@ def add_annotation_qc_flags(ds, annotations):
     return ds
 
 
+@memoize
 def get_vocabulary(site, node, sensor):
     """
     Based on the site, node and sensor name download the vocabulary record defining this sensor.
+    The result is cached and shared with other callers, so make a copy before modifying it.
 
     :param site: Site name to query
     :param node: Node name to query
     :param sensor: Sensor name to query
     :return: json object with the site-node-sensor specific vocabulary
     """
-    r = SESSION.get(BASE_URL + VOCAB_URL + site + '/' + node +
-                    '/' + sensor, auth=(AUTH[0], AUTH[2]))
+    r = get_session().get(BASE_URL + VOCAB_URL + site + '/' + node +
+                          '/' + sensor, timeout=DEFAULT_TIMEOUT)
     if r.status_code == requests.codes.ok:
-        return r.json()
+        return parse_json(r)
     else:
         return None
 
@@ -606,10 +848,10 @@ def m2m_request(site, node, sensor, method, stream, start=None, stop=None):
         end_date = ''
 
     options = begin_date + end_date + '&format=application/netcdf'
-    r = SESSION.get(BASE_URL + SENSOR_URL + site + '/' + node + '/' + sensor + '/' + method + '/' + stream + options,
-                    auth=(AUTH[0], AUTH[2]))
+    r = get_session().get(BASE_URL + SENSOR_URL + site + '/' + node + '/' + sensor + '/' + method + '/' + stream +
+                          options, timeout=DEFAULT_TIMEOUT)
     if r.status_code == requests.codes.ok:
-        data = r.json()
+        data = parse_json(r)
     else:
         return None
 
@@ -621,17 +863,27 @@ def m2m_request(site, node, sensor, method, stream, start=None, stop=None):
     print('Waiting for OOINet to process and prepare data request, this may take up to 20 minutes.')
     url = [url for url in data['allURLs'] if re.match(r'.*async_results.*', url)][0]
     check_complete = url + '/status.txt'
-    with tqdm(total=400, desc='Waiting', file=sys.stdout) as bar:
-        for i in range(400):
-            r = SESSION.get(check_complete)
-            bar.update()
-            bar.refresh()
-            if r.status_code == requests.codes.ok:
-                bar.n = 400
-                bar.last_print_n = 400
-                break
-            else:
-                time.sleep(3)
+
+    # poll the status file with an exponential backoff (starting at 0.5 s, capped at 10 s between checks) until the
+    # request is complete, or we have waited 20 minutes. only the status code matters, so use HEAD rather than GET.
+    timeout = 1200
+    delay = 0.5
+    elapsed = 0
+    start_time = time.time()
+    with tqdm(total=timeout, desc='Waiting', unit='s', file=sys.stdout) as bar:
+        while elapsed < timeout:
+            try:
+                r = get_session().head(check_complete, timeout=DEFAULT_TIMEOUT)
+                if r.status_code == requests.codes.ok:
+                    bar.update(timeout - bar.n)
+                    break
+            except requests.exceptions.RequestException:
+                pass    # a failed status check (e.g. a timeout) is not fatal, keep waiting and check again
+
+            time.sleep(delay)
+            delay = min(delay * 1.5, 10)
+            elapsed = time.time() - start_time
+            bar.update(min(elapsed, timeout) - bar.n)
 
     return data
 
@@ -649,34 +901,30 @@ def m2m_collect(data, tag='.*\\.nc$'):
     url = [url for url in data['allURLs'] if re.match(r'.*thredds.*', url)][0]
     files = list_files(url, tag)
 
-    # Process the data files found above and concatenate into a single data set
+    # Download the data files found above (concurrently, or use the locally cached copies) and concatenate them into a
+    # single data set
     print('Downloading %d data file(s) from the OOI THREDSS catalog' % len(files))
-    frames = []
-    with tqdm(total=len(files), desc='Waiting', file=sys.stdout) as bar:
-        for f in files:
-            frames.append(process_file(f))
-            bar.update()
-            bar.refresh()
-
-    if not frames:
+    if not files:
         return None
 
-    # merge the frames into a single data set, preserving global attributes from the first file if more than one.
-    m2m = frames[0]
-    if len(frames) > 1:
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        paths = []
         try:
-            # concatenation handles 99% of the cases
-            m2m = xr.concat(frames, dim='time')
-        except ValueError:  # unless there are missing variables ...
-            for i in range(1, len(frames)):
-                try:
-                    # merging will address most of the remaining cases
-                    m2m = m2m.merge(frames[i])
-                except ValueError:
-                    # but sometimes there just really is something wrong with a dataset
-                    message = "Corrupted data in file {} of {}, skipping merge of this file".format(
-                        i+1, len(frames))
-                    warnings.warn(message)
+            with tqdm(total=len(files), desc='Waiting', file=sys.stdout) as bar:
+                with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+                    for path in executor.map(fetch_file, files, [tmp_dir] * len(files)):
+                        paths.append(path)
+                        bar.update()
+                        bar.refresh()
+
+            m2m = combine_files(paths)
+        finally:
+            release_files(paths)
+
+    # now that the data is loaded, remove the least recently used files if the local cache has grown too large
+    trim_cache()
+    if m2m is None:
+        return None
 
     m2m = m2m.sortby('deployment')
     m2m.attrs['time_coverage_start'] = ('%sZ' % m2m.time.min().values)
@@ -687,6 +935,44 @@ def m2m_collect(data, tag='.*\\.nc$'):
     return m2m
 
 
+def combine_files(paths):
+    """
+    Open the downloaded data files, clean them up and combine them into a single data set.
+
+    :param paths: list of the local paths to the downloaded data files
+    :return: the combined data as an xarray dataset, or None if there is no data
+    """
+    try:
+        # opening the files as a single data set, cleaning up each file as it is opened (opens are spread across
+        # the dask workers), and concatenating along time handles 99% of the cases
+        with xr.open_mfdataset(paths, engine='h5netcdf', parallel=True, combine='nested', concat_dim='time',
+                               preprocess=clean_file, drop_variables=DROP_VARS) as mfd:
+            return mfd.load()
+    except ValueError:  # unless there are missing variables ...
+        frames = []
+        for path in paths:
+            ds = xr.load_dataset(path, engine='h5netcdf', drop_variables=DROP_VARS)
+            if ds:
+                frames.append(clean_file(ds))
+
+        if not frames:
+            return None
+
+        # merge the frames into a single data set, preserving global attributes from the first file
+        m2m = frames[0]
+        for i in range(1, len(frames)):
+            try:
+                # merging will address most of the remaining cases
+                m2m = m2m.merge(frames[i])
+            except ValueError:
+                # but sometimes there just really is something wrong with a dataset
+                message = "Corrupted data in file {} of {}, skipping merge of this file".format(
+                    i+1, len(frames))
+                warnings.warn(message)
+
+        return m2m
+
+
 def list_files(url, tag='.*\\.nc$'):
     """
     Function to create a list of the NetCDF data files in the THREDDS catalog created by a request to the M2M system.
@@ -695,42 +981,179 @@ def list_files(url, tag='.*\\.nc$'):
     :param tag: regex pattern used to distinguish files of interest
     :return: list of files in the catalog with the URL path set relative to the catalog
     """
-    page = SESSION.get(url).text
-    soup = BeautifulSoup(page, 'html.parser')
-    pattern = re.compile(tag)
-    return [node.get('href') for node in soup.find_all('a', text=pattern)]
+    page = get_session().get(url, headers={'Accept': 'text/html'}, timeout=DEFAULT_TIMEOUT).content
+    tree = html.fromstring(page)
+    hrefs = tree.xpath('//a[re:test(string(.), $tag)]/@href', tag=tag,
+                       namespaces={'re': 'http://exslt.org/regular-expressions'})
+    return [str(href) for href in hrefs]
+
+
+def download_file(url, path):
+    """
+    Download a file via HTTP, streaming the contents to disk in chunks rather than holding the whole file in memory.
+
+    :param url: URL of the file to download
+    :param path: local path to save the file to
+    :return: None
+    """
+    with get_session().get(url, stream=True, headers={'Accept': '*/*'}, timeout=DOWNLOAD_TIMEOUT) as r:
+        r.raise_for_status()
+        with open(path, 'wb') as f:
+            for chunk in r.iter_content(chunk_size=1024 * 1024):
+                f.write(chunk)
+
+
+def fetch_file(catalog_file, tmp_dir):
+    """
+    Download one of the NetCDF files from the THREDDS catalog in a single request using the HTTP file server, rather
+    than reading it variable by variable via OPeNDAP. If the local cache is enabled (CONFIG['cache_size'] > 0), the
+    file is saved to the cache and a copy already there from an earlier request for the same data is used instead of
+    downloading it again. Cached files must be released with release_files once they are no longer needed. If OOI
+    reprocesses the data, the cached copies will be out of date and should be removed from the cache.
+
+    :param catalog_file: Unique file, referenced by a URL relative to the catalog, to download
+    :param tmp_dir: temporary directory to save the file to if the cache is disabled
+    :return: path to the local copy of the file
+    """
+    file_url = 'https://opendap.oceanobservatories.org/thredds/fileServer/'
+    url = CATALOG_RE.sub(file_url, catalog_file)
+    name = os.path.basename(url)
+    if CONFIG['cache_size'] > 0:
+        # the data file names are unique to the reference designator, method, stream, deployment and time range of
+        # the data, rather than to the request, so they are used to name the cached copies
+        file_dir = os.path.join(CONFIG['cache_dir'], 'thredds')
+        os.makedirs(file_dir, exist_ok=True)
+        path = os.path.join(file_dir, name)
+        with CACHE_LOCK:
+            CACHE_IN_USE[path] += 1
+        try:
+            os.utime(path)  # mark the file as recently used
+            return path
+        except FileNotFoundError:
+            pass    # not in the cache yet, download it below
+    else:
+        file_dir = tmp_dir
+        path = os.path.join(tmp_dir, name)
+
+    # download to a temporary file first and then move it into place, so a partial download is never used
+    fd, tmp = tempfile.mkstemp(suffix='.part', dir=file_dir)
+    os.close(fd)
+    try:
+        with THREDDS_LIMIT:
+            download_file(url, tmp)
+        os.replace(tmp, path)
+    except Exception:
+        release_files([path])
+        raise
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+    return path
+
+
+def release_files(paths):
+    """
+    Release cached THREDDS data files returned by fetch_file, so they can be removed from the cache by trim_cache.
+
+    :param paths: list of the local paths to the data files
+    :return: None
+    """
+    with CACHE_LOCK:
+        for path in paths:
+            if CACHE_IN_USE[path] > 1:
+                CACHE_IN_USE[path] -= 1
+            else:
+                CACHE_IN_USE.pop(path, None)
+
+
+def trim_cache():
+    """
+    Remove the least recently used files from the local cache of THREDDS data files until the total size of the cache
+    is no larger than the limit set by CONFIG['cache_size']. Files in use by this process are kept, and partial
+    downloads orphaned by a killed process are removed.
+
+    :return: None
+    """
+    cache_dir = os.path.join(CONFIG['cache_dir'], 'thredds')
+    if not os.path.isdir(cache_dir):
+        return
+
+    now = time.time()
+    files = []
+    for name in os.listdir(cache_dir):
+        path = os.path.join(cache_dir, name)
+        try:
+            stat = os.stat(path)
+            if name.endswith('.part'):
+                if now - stat.st_mtime > PART_EXPIRE:
+                    os.remove(path)
+            elif name.endswith('.nc'):
+                files.append((stat.st_atime, stat.st_size, path))
+        except FileNotFoundError:
+            continue    # removed by another process in the meantime
+
+    with CACHE_LOCK:
+        in_use = set(CACHE_IN_USE)
+
+    total = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total <= CONFIG['cache_size']:
+            break
+        if path in in_use:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass    # removed by another process in the meantime
+        total -= size
 
 
 def process_file(catalog_file):
     """
-    Function to download one of the NetCDF files as an xarray data set, convert to time as the appropriate dimension
-    instead of obs, and drop the extraneous timestamp variables (these were originally not intended to be exposed to
-    users and lead to confusion as to their meaning). The ID and provenance variables are better off obtained directly
-    from the M2M system via a different process. Having them included imposes unnecessary constraints on the processing.
+    Function to download one of the NetCDF files as an xarray data set and clean it up for further processing (see
+    clean_file).
 
     :param catalog_file: Unique file, referenced by a URL relative to the catalog, to download and convert the data
         file to an xarray data set.
     :return: downloaded data in an xarray dataset.
     """
-    dods_url = 'https://opendap.oceanobservatories.org/thredds/dodsC/'
-    url = re.sub('catalog.html\?dataset=', dods_url, catalog_file)
-    ds = xr.load_dataset(url + '#fillmismatch')
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        path = fetch_file(catalog_file, tmp_dir)
+        try:
+            with xr.open_dataset(path, engine='h5netcdf', drop_variables=DROP_VARS) as xrd:
+                ds = xrd.load()
+        finally:
+            release_files([path])
+
+    trim_cache()
 
     if not ds:
         return None
 
+    return clean_file(ds)
+
+
+def clean_file(ds):
+    """
+    Function to convert one of the downloaded NetCDF files to use time as the appropriate dimension instead of obs,
+    and drop the extraneous timestamp variables (these were originally not intended to be exposed to users and lead to
+    confusion as to their meaning). The ID and provenance variables are better off obtained directly from the M2M
+    system via a different process. Having them included imposes unnecessary constraints on the processing.
+
+    :param ds: xarray data set of one of the downloaded NetCDF files
+    :return: cleaned up xarray dataset.
+    """
     # addresses error in how the *_qartod_executed variables are set
-    qartod_pattern = re.compile(r'^.+_qartod_executed$')
     for v in ds.variables:
-        if qartod_pattern.match(v):
-            # the shape of the QARTOD executed variables should compare to the provenance variable
-            if ds[v].shape != ds['provenance'].shape:
+        if QARTOD_EXECUTED_RE.match(v):
+            # the shape of the QARTOD executed variables should compare to the time variable (one value per obs)
+            if ds[v].shape != ds['time'].shape:
                 ds = ds.drop_vars(v)
 
     ds = ds.swap_dims({'obs': 'time'})
     ds = ds.reset_coords()
-    keys = ['obs', 'id', 'provenance', 'driver_timestamp', 'ingestion_timestamp',
-            'port_timestamp', 'preferred_timestamp']
+    keys = ['obs'] + DROP_VARS
     for key in keys:
         if key in ds.variables:
             ds = ds.drop_vars(key)
@@ -743,7 +1166,7 @@ def process_file(catalog_file):
         if key in ds.attrs:
             del(ds.attrs[key])
 
-    if ds.encoding['unlimited_dims']:
+    if ds.encoding.get('unlimited_dims'):
         del ds.encoding['unlimited_dims']
 
     # resetting cdm_data_type from Point to Station and the featureType from point to timeSeries
@@ -766,9 +1189,9 @@ def update_dataset(ds, depth):
     :param depth: instrument deployment depth
     :return ds: The updated data set
     """
-    # add a default station identifier as a coordinate variable to the data set
-    ds.coords['station'] = 0
-    ds = ds.expand_dims('station', axis=None)
+    # add a default station identifier as a coordinate variable and dimension to the data set (expand_dims inserts
+    # the new length-1 axis as a view of the existing arrays, so nothing is copied here)
+    ds = ds.expand_dims(station=[0])
     ds['station'].attrs = dict({
         'cf_role': 'timeseries_id',
         'long_name': 'Station Identifier',
@@ -828,40 +1251,37 @@ def update_dataset(ds, depth):
     # merge the geospatial coordinates into the data set
     ds = ds.merge(geo_coords)
 
-    # update coordinate attributes for all variables
-    for v in ds.variables:
-        if v not in ['time', 'lat', 'lon', 'z', 'station']:
-            ds[v].attrs['coordinates'] = 'time lon lat z'
-
-    # update some variable attributes to get somewhat closer to IOOS compliance, more importantly convert QC variables
-    # to bytes and set the attributes to define the flag masks and meanings.
+    # in a single pass through the variables, update the coordinate attributes for all variables, update some variable
+    # attributes to get somewhat closer to IOOS compliance, more importantly convert QC variables to bytes and set the
+    # attributes to define the flag masks and meanings, and convert all float64 values to float32 (except time, which
+    # is converted below).
     ds['deployment'].attrs['long_name'] = 'Deployment Number'   # add missing long_name attribute
-    qc_pattern = re.compile(r'^.+_qc_.+$')
-    executed_pattern = re.compile(r'^.+_qc_executed$')
-    results_pattern = re.compile(r'^.+_qc_results$')
-    qartod_results = re.compile(r'^.+_qartod_results$')
     flag_masks = np.array([1, 2, 4, 8, 16, 32, 64, 128], dtype=np.uint8)
-    for v in ds.variables:
-        if qartod_results.match(v):  # make sure set as integer
+    for v in list(ds.variables):
+        if v not in COORD_VARS:
+            ds[v].attrs['coordinates'] = 'time lon lat z'
+
+        if QARTOD_RESULTS_RE.match(v):  # make sure set as integer
             ds[v] = ds[v].astype('int32')
 
-        if qc_pattern.match(v):      # update QC variables
-            ds[v] = (('station', 'time'), [[np.uint8(x) for x in ds[v].values[0]]])
+        qc = QC_RE.match(v)
+        if qc:                          # update QC variables
+            ds[v] = (ds[v].dims, ds[v].values.astype(np.uint8))
             ds[v].attrs['long_name'] = re.sub('Qc', 'QC', re.sub('_', ' ', v.title()))
 
-            if executed_pattern.match(v):   # *_qc_executed variables
+            ancillary = qc.group('base')
+            if qc.group('kind') == 'executed':  # *_qc_executed variables
                 ds[v].attrs['flag_masks'] = flag_masks
                 ds[v].attrs['flag_meanings'] = ('global_range_test local_range_test spike_test poly_trend_test ' +
                                                 'stuck_value_test gradient_test propogate_flags')
                 ds[v].attrs['comment'] = 'Automated QC tests executed for the associated named variable.'
 
-                ancillary = re.sub('_qc_executed', '', v)
                 ds[v].attrs['ancillary_variables'] = ancillary
                 if 'standard_name' in ds[ancillary].attrs:
                     ds[v].attrs['standard_name'] = ds[ancillary].attrs['standard_name'] + \
                         ' qc_tests_executed'
 
-            if results_pattern.match(v):    # *_qc_results variables
+            if qc.group('kind') == 'results':   # *_qc_results variables
                 ds[v].attrs['flag_masks'] = flag_masks
                 ds[v].attrs['flag_meanings'] = ('global_range_test_passed local_range_test_passed spike_test_passed ' +
                                                 'poly_trend_test_passed stuck_value_test_passed gradient_test_passed ' +
@@ -869,11 +1289,14 @@ def update_dataset(ds, depth):
                 ds[v].attrs['comment'] = ('QC result flags are set to true (1) if the test passed. Otherwise, if ' +
                                           'the test failed or was not executed, the flag is set to false (0).')
 
-                ancillary = re.sub('_qc_results', '', v)
                 ds[v].attrs['ancillary_variables'] = ancillary
                 if 'standard_name' in ds[ancillary].attrs:
                     ds[v].attrs['standard_name'] = ds[ancillary].attrs['standard_name'] + ' qc_tests_results'
 
+        if v not in ['time', 'internal_timestamp']:
+            if ds[v].dtype is np.dtype('float64'):
+                ds[v] = ds[v].astype('float32')
+
     # convert the time values from a datetime64[ns] object to a floating point number with the time in seconds
     ds['time'] = dt64_epoch(ds.time)
     ds['time'].attrs = dict({
@@ -884,12 +1307,6 @@ def update_dataset(ds, depth):
         'calendar': 'gregorian'
     })
 
-    # convert all float64 values to float32
-    for v in ds.variables:
-        if v not in ['time', 'internal_timestamp']:
-            if ds[v].dtype is np.dtype('float64'):
-                ds[v] = ds[v].astype('float32')
-
     # return the data set for further work
     return ds
 
@@ -902,7 +1319,7 @@ def dt64_epoch(dt64):
     :param dt64: panda or xarray datatime64 object
     :return epts: epoch time as seconds since 1970-01-01
     """
-    epts = dt64.values.astype(float) / 10.0 ** 9
+    epts = np.asarray(dt64.values, dtype='datetime64[ns]').view('int64') * 1e-9
     return epts
 
 
@@ -910,15 +1327,22 @@ def dict_update(source, overrides):
     """
     Update a nested dictionary or similar mapping. Modifies ``source`` in place.
 
-    From https://stackoverflow.com/a/30655448. Replaces original dict_update used by poceans-core, also pulled from
-    the same thread.
+    Adapted from https://stackoverflow.com/a/30655448. Replaces original dict_update used by poceans-core, also pulled
+    from the same thread. Walks the nested mappings with an explicit stack rather than recursion.
     """
-    for key, value in overrides.items():
-        if isinstance(value, collections.Mapping) and value:
-            returned = dict_update(source.get(key, {}), value)
-            source[key] = returned
-        else:
-            source[key] = overrides[key]
+    stack = [(source, overrides)]
+    while stack:
+        target, updates = stack.pop()
+        for key, value in updates.items():
+            if isinstance(value, Mapping) and value:
+                child = target.get(key)
+                if not isinstance(child, MutableMapping):
+                    # create (or replace a non-mapping value with) a new dictionary to merge the nested values into
+                    child = {}
+                    target[key] = child
+                stack.append((child, value))
+            else:
+                target[key] = value
     return source
 
 
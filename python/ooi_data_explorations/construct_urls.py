@@ -6,8 +6,8 @@
 """
 import requests
 
-from ooi_data_explorations.common import AUTH, BASE_URL
-from ooi_data_explorations.common import list_nodes, list_sensors, list_methods, list_streams
+from ooi_data_explorations.common import get_session, BASE_URL, DEFAULT_TIMEOUT, parse_json
+from ooi_data_explorations.common import crawl_site
 
 # Organize the nodes into assemblies common across all the arrays. Helps to better organize the data, taking all the
 # different names used in OOI and collapsing them down to a more coherent, and logical grouping. This list is
@@ -92,9 +92,9 @@ def get_vocabulary():
 
     :return: json object with the site-node-sensor specific vocabulary
     """
-    r = requests.get(BASE_URL + '12586/vocab', auth=(AUTH[0], AUTH[2]))
+    r = get_session().get(BASE_URL + '12586/vocab', timeout=DEFAULT_TIMEOUT)
     if r.status_code == requests.codes.ok:
-        return r.json()
+        return parse_json(r)
     else:
         return None
 
@@ -127,8 +127,13 @@ def add_site(site, url_file):
         f.write('{sp}name: {name}\n'.format(sp=sp*1, name=site_vocab['tocL2']))
         f.write('{sp}assembly:\n'.format(sp=sp*1))
 
-        # create a list of nodes for this site
-        nodes = list_nodes(site)
+        # crawl the inventory of nodes, sensors, methods and streams for this site, limited to the nodes in the
+        # assemblies, and the sensors and methods of interest as defined above, and create a list of the nodes
+        assembly_nodes = set(n for v in ASSEMBLY.values() for n in v)
+        inventory = crawl_site(site, node_filter=lambda n: n in assembly_nodes,
+                               sensor_filter=lambda s: not any(sub in s for sub in SENSOR_EXCLUDES),
+                               method_filter=lambda m: m in METHODS)
+        nodes = list(inventory)
 
         # for each node, if it is one of interest as defined above, create an assembly entry
         for k, v in ASSEMBLY.items():
@@ -154,7 +159,7 @@ def add_site(site, url_file):
                     if n in w:
                         f.write('{sp}subassembly: {name}\n'.format(sp=sp * 3, name=l))
                 f.write('{sp}instrument:\n'.format(sp=sp * 3))
-                sensors = list_sensors(site, n)
+                sensors = list(inventory[n])
                 sensors = filter_stream(sensors, SENSOR_EXCLUDES)   # remove sensors of no interest
 
                 if not sensors:
@@ -176,14 +181,14 @@ def add_site(site, url_file):
                     f.write('{sp}sensor: {sensor}\n'.format(sp=sp*5, sensor=sensor))
                     f.write('{sp}stream:\n'.format(sp=sp*5))
 
-                    methods = list_methods(site, n, sensor)
+                    methods = list(inventory[n][sensor])
                     if not methods:
                         f.write('{sp}unknown: null\n'.format(sp=sp*6,))
                         continue
 
                     for method in methods:
                         if method in METHODS:
-                            streams = list_streams(site, n, sensor, method)
+                            streams = inventory[n][sensor][method]
                             streams = filter_stream(streams, STREAM_EXCLUDES)
                             if len(streams) == 1:
                                 f.write('{sp}{method}: {streams}\n'.format(sp=sp*6, method=method,
@@ -38,6 +38,7 @@ setup(
     packages = find_packages(),
     install_requires = [
         'xarray',
+        'dask',
         'munch',
         'tqdm',
         'urllib3',
@@ -45,8 +46,10 @@ setup(
         'pandas',
         'gsw',
         'requests',
-        'beautifulsoup4',
-        'PyYAML'
+        'requests-cache',
+        'lxml',
+        'PyYAML',
+        'h5netcdf'
     ],
     include_package_data=True,
     zip_safe=False